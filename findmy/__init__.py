@@ -27,8 +27,11 @@
 #               (https://github.com/muehlt/home-assistant-findmy).
 
 from datetime import datetime
+from functools import lru_cache
 import math
 import re
+import socket
+import string
 import time
 import click
 import paho.mqtt.client as mqtt
@@ -36,12 +39,32 @@ import os
 import json
 from unidecode import unidecode
 from dotenv import load_dotenv
-from rich.console import Console
+from rich.console import Console, Group
+from rich.live import Live
 from rich.table import Table
+from rich.text import Text
+
+try:
+    from orjson import dumps as json_dumps, loads as json_loads
+except ImportError:
+    from json import dumps as json_dumps, loads as json_loads
 
 load_dotenv()
 
 DEFAULT_TOLERANCE = 70  # meters
+MQTT_KEEPALIVE = 120  # seconds
+
+SOURCE_TYPES = {
+    "crowdsourced": "gps",  # ble only used for stationary ble trackers
+    "safeLocation": "gps",
+    "Wifi": "router"
+}
+
+DEVICE_ID_SEPARATORS = re.compile(r'[\s-]')
+# unidecode returns ascii, so all remaining characters except [0-9a-zA-Z_-] can be removed with str.translate
+DEVICE_ID_INVALID_CHARACTERS = str.maketrans('', '', ''.join(
+    character for character in map(chr, range(128))
+    if character not in string.ascii_letters + string.digits + '_-'))
 
 (mqtt_broker_ip,
  mqtt_broker_port,
@@ -54,16 +77,35 @@ cache_file_location_items = cache_file_location + 'Items.data'
 cache_file_location_devices = cache_file_location + 'Devices.data'
 
 known_locations = {}
+known_location_bounds = []
 device_updates = {}
+device_configs = {}
+cache_file_modification_times = {}
 
 client = mqtt.Client("ha-client")
 
+
+def on_connect(mqtt_client, _userdata, _flags, _rc):
+    # send the small update messages right away instead of waiting for Nagle's algorithm
+    mqtt_client.socket().setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    # publish all device configs again after (re)connecting to the broker
+    device_configs.clear()
+
+
 def connect_broker():
+    client.on_connect = on_connect
     client.username_pw_set(mqtt_client_username, mqtt_client_password)
-    client.connect(host=mqtt_broker_ip, port=mqtt_broker_port)
+    client.reconnect_delay_set(min_delay=1, max_delay=30)
+    client.connect(host=mqtt_broker_ip, port=mqtt_broker_port, keepalive=MQTT_KEEPALIVE)
     client.loop_start()
 
 
+def disconnect_broker():
+    client.disconnect()
+    client.loop_stop()
+
+
 def get_time(timestamp):
     if (type(timestamp) is not int):
         return "unknown"
@@ -74,167 +116,193 @@ def get_lat_lng_approx(meters):
     return meters / 111111
 
 
+def has_changed(data_file):
+    modification_time = os.stat(data_file).st_mtime_ns
+    if cache_file_modification_times.get(data_file) == modification_time:
+        return False
+    cache_file_modification_times[data_file] = modification_time
+    return True
+
+
 def load_data(data_file):
-    with open(data_file, 'r') as f:
-        data = json.load(f)
-        f.close()
-        return data
+    with open(data_file, 'rb') as f:
+        return json_loads(f.read())
 
 
+@lru_cache(maxsize=512)
 def get_device_id(name):
-    device_id = unidecode(re.sub(r'[\s-]', '_', name).lower())
-    return re.sub('[_]+', '_', re.sub('[^0-9a-zA-Z_-]+', '', device_id))
+    device_id = unidecode(DEVICE_ID_SEPARATORS.sub('_', name).lower()).translate(DEVICE_ID_INVALID_CHARACTERS)
+    while '__' in device_id:
+        device_id = device_id.replace('__', '_')
+    return device_id
 
 
 def get_source_type(apple_position_type):
-    switcher = {
-        "crowdsourced": "gps",  # ble only used for stationary ble trackers
-        "safeLocation": "gps",
-        "Wifi": "router"
-    }
-    return switcher.get(apple_position_type, "gps")
+    return SOURCE_TYPES.get(apple_position_type, "gps")
 
 
 def get_location_name(pos):
-    for name, location in known_locations.items():
-        tolerance = get_lat_lng_approx(location['tolerance'] or DEFAULT_TOLERANCE)
-        if (math.isclose(location['latitude'], pos[0], abs_tol=tolerance) and
-                math.isclose(location['longitude'], pos[1], abs_tol=tolerance)):
+    latitude, longitude = pos
+    for name, location_latitude, location_longitude, tolerance in known_location_bounds:
+        if abs(location_latitude - latitude) <= tolerance and abs(location_longitude - longitude) <= tolerance:
             return name
     return "not_home"
 
 
-def send_data_items(force_sync):
-    for device in load_data(cache_file_location_items):
-        device_name = device['name']
-        battery_status = device['batteryStatus']
-        source_type = get_source_type(device.get('location').get('positionType') if device.get('location') else None)
+class Device:
+    __slots__ = ('name', 'id', 'battery_status', 'battery_level', 'source_type',
+                 'latitude', 'longitude', 'address', 'accuracy', 'location_name',
+                 'last_update_timestamp', 'last_update')
+
+    def __init__(self, device_data):
+        location = device_data['location']
+
+        self.name = device_data['name']
+        self.id = get_device_id(self.name)
+        self.battery_status = device_data['batteryStatus']
+        self.battery_level = device_data.get('batteryLevel')
+        self.source_type = get_source_type(location.get('positionType') if location else None)
+
+        self.last_update_timestamp = self.get_last_update_timestamp(device_data)
+        self.location_name = self.address = self.latitude = self.longitude = self.accuracy = "unknown"
+        if location is not None:
+            self.latitude = location['latitude']
+            self.longitude = location['longitude']
+            self.address = device_data['address']
+            self.accuracy = math.hypot(location['horizontalAccuracy'], location['verticalAccuracy'])
+            self.location_name = get_location_name((self.latitude, self.longitude))
+        self.last_update = get_time(self.last_update_timestamp)
+
+    @staticmethod
+    def get_last_update_timestamp(device_data):
+        location = device_data['location']
+        return location['timeStamp'] if location is not None else "unknown"
+
+    def get_battery_attributes(self):
+        return {
+            "battery_status": self.battery_status,
+            "battery_level": self.battery_level
+        }
 
-        location_name = address = latitude = longitude = accuracy = lastUpdate = "unknown"
-        if device['location'] is not None:
-            latitude = device['location']['latitude']
-            longitude = device['location']['longitude']
-            address = device['address']
-            accuracy = math.sqrt(
-                device['location']['horizontalAccuracy'] ** 2 + device['location']['verticalAccuracy'] ** 2)
-            location_name = get_location_name((latitude, longitude))
-            lastUpdate = device['location']['timeStamp']
+    def get_attributes(self):
+        return {
+            "latitude": self.latitude,
+            "longitude": self.longitude,
+            "gps_accuracy": self.accuracy,
+            "address": self.address,
+            **self.get_battery_attributes(),
+            "last_update_timestamp": self.last_update_timestamp,
+            "last_update": self.last_update,
+            "provider": "FindMy (muehlt/home-assistant-findmy)"
+        }
 
-        device_id = get_device_id(device_name)
-        updates_identifier = f"{device_name} ({device_id})"
 
-        device_update = device_updates.get(updates_identifier)
-        if not force_sync and device_update and len(device_update) > 0 and device_update[0] == lastUpdate:
-            continue
+class Item(Device):
+    __slots__ = ()
 
-        device_updates[updates_identifier] = (lastUpdate, location_name)
-        device_topic = f"homeassistant/device_tracker/{device_id}/"
-        device_config = {
-            "unique_id": device_id,
-            "state_topic": device_topic + "state",
-            "json_attributes_topic": device_topic + "attributes",
-            "device": {
-                "identifiers": device_id,
-                "manufacturer": "Apple",
-                "name": device_name
-            },
-            "source_type": source_type,
-            "payload_home": "home",
-            "payload_not_home": "not_home"
-        }
-        device_attributes = {
-            "latitude": latitude,
-            "longitude": longitude,
-            "gps_accuracy": accuracy,
-            "address": address,
-            "batteryStatus": battery_status,
-            "last_update_timestamp": lastUpdate,
-            "last_update": get_time(lastUpdate),
-            "provider": "FindMy (muehlt/home-assistant-findmy)"
+    def get_battery_attributes(self):
+        return {
+            "batteryStatus": self.battery_status
         }
 
-        client.publish(device_topic + "config", json.dumps(device_config))
-        client.publish(device_topic + "attributes", json.dumps(device_attributes))
-        client.publish(device_topic + "state", location_name)
-
-
-def send_data_devices(force_sync):
-    for device in load_data(cache_file_location_devices):
-        device_name = device['name']
-        battery_status = device['batteryStatus']
-        battery_sevel = device['batteryLevel']
-        source_type = get_source_type(device.get('location').get('positionType') if device.get('location') else None)
-
-        location_name = address = latitude = longitude = accuracy = lastUpdate = "unknown"
-        if device['location'] is not None:
-            latitude = device['location']['latitude']
-            longitude = device['location']['longitude']
-            address = device['address']
-            accuracy = math.sqrt(
-                device['location']['horizontalAccuracy'] ** 2 + device['location']['verticalAccuracy'] ** 2)
-            location_name = get_location_name((latitude, longitude))
-            lastUpdate = device['location']['timeStamp']
-
-        device_id = get_device_id(device_name)
-        updates_identifier = f"{device_name} ({device_id})"
-
-        device_update = device_updates.get(updates_identifier)
-        if not force_sync and device_update and len(device_update) > 0 and device_update[0] == lastUpdate:
+
+@lru_cache(maxsize=512)
+def get_device_topics(device_id):
+    device_topic = f"homeassistant/device_tracker/{device_id}/"
+    return device_topic + "config", device_topic + "attributes", device_topic + "state"
+
+
+@lru_cache(maxsize=512)
+def get_device_config(device_id, device_name, source_type):
+    _config_topic, attributes_topic, state_topic = get_device_topics(device_id)
+    return json_dumps({
+        "unique_id": device_id,
+        "state_topic": state_topic,
+        "json_attributes_topic": attributes_topic,
+        "device": {
+            "identifiers": device_id,
+            "manufacturer": "Apple",
+            "name": device_name
+        },
+        "source_type": source_type,
+        "payload_home": "home",
+        "payload_not_home": "not_home"
+    })
+
+
+def publish_to_mqtt(device):
+    config_topic, attributes_topic, state_topic = get_device_topics(device.id)
+    device_config = get_device_config(device.id, device.name, device.source_type)
+
+    # the config is retained by the broker, so it is only published again if it changed
+    if device_configs.get(device.id) != device_config:
+        client.publish(config_topic, device_config, qos=0, retain=True)
+        device_configs[device.id] = device_config
+
+    client.publish(attributes_topic, json_dumps(device.get_attributes()), qos=0)
+    client.publish(state_topic, device.location_name, qos=0)
+
+
+def send_location_data(data_file, device_class, force_sync):
+    if not force_sync and not has_changed(data_file):
+        return False
+
+    updated = False
+
+    for device_data in load_data(data_file):
+        # skip unchanged devices before parsing the rest of their data
+        device_update = device_updates.get(get_device_id(device_data['name']))
+        if (not force_sync and device_update and
+                device_update.last_update_timestamp == device_class.get_last_update_timestamp(device_data)):
             continue
 
-        device_updates[updates_identifier] = (lastUpdate, location_name)
-        device_topic = f"homeassistant/device_tracker/{device_id}/"
-        device_config = {
-            "unique_id": device_id,
-            "state_topic": device_topic + "state",
-            "json_attributes_topic": device_topic + "attributes",
-            "device": {
-                "identifiers": device_id,
-                "manufacturer": "Apple",
-                "name": device_name
-            },
-            "source_type": source_type,
-            "payload_home": "home",
-            "payload_not_home": "not_home"
-        }
-        device_attributes = {
-            "latitude": latitude,
-            "longitude": longitude,
-            "gps_accuracy": accuracy,
-            "address": address,
-            "battery_status": battery_status,
-            "battery_level": battery_sevel,
-            "last_update_timestamp": lastUpdate,
-            "last_update": get_time(lastUpdate),
-            "provider": "FindMy (muehlt/home-assistant-findmy)"
-        }
+        device = device_class(device_data)
+        device_updates[device.id] = device
+        publish_to_mqtt(device)
+        updated = True
+
+    return updated
 
-        client.publish(device_topic + "config", json.dumps(device_config))
-        client.publish(device_topic + "attributes", json.dumps(device_attributes))
-        client.publish(device_topic + "state", location_name)
+
+def send_cache_data(force_sync):
+    items_updated = send_location_data(cache_file_location_items, Item, force_sync)
+    devices_updated = send_location_data(cache_file_location_devices, Device, force_sync)
+    return items_updated or devices_updated
+
+
+def get_device_table():
+    device_table = Table()
+    device_table.add_column("Device")
+    device_table.add_column("Last Update")
+    device_table.add_column("Location")
+    for device in sorted(device_updates.values(), key=lambda x: x.last_update):
+        device_table.add_row(f"{device.name} ({device.id})", device.last_update, device.location_name)
+    return device_table
+
+
+def get_console_output(privacy):
+    status = Text.from_markup(
+        f"[bold green]Synchronizing {len(device_updates)} devices and {len(known_locations)} known locations")
+    if privacy:
+        return status
+    return Group(get_device_table(), status)
 
 
 def scan_cache(privacy, force_sync):
     console = Console()
-    with console.status(
-            f"[bold green]Synchronizing {len(device_updates)} devices and {len(known_locations)} known locations") as status:
-        while True:
-            send_data_items(force_sync)
-            send_data_devices(force_sync)
-
-            os.system('clear')
 
-            if not privacy:
-                device_table = Table()
-                device_table.add_column("Device")
-                device_table.add_column("Last Update")
-                device_table.add_column("Location")
-                for device, details in sorted(device_updates.items(), key=lambda x: get_time(x[1][0])):
-                    device_table.add_row(device, get_time(details[0]), details[1])
-                console.print(device_table)
+    if not console.is_terminal:
+        # rich Live only renders to a terminal, so print the device table after every update instead
+        while True:
+            if send_cache_data(force_sync) and not privacy:
+                console.print(get_device_table())
+            time.sleep(findmy_file_scan_interval)
 
-            status.update(
-                f"[bold green]Synchronizing {len(device_updates)} devices and {len(known_locations)} known locations")
+    with Live(get_console_output(privacy), console=console, screen=True, auto_refresh=False) as live:
+        while True:
+            # only rebuild and repaint the console output if a device was updated
+            if send_cache_data(force_sync):
+                live.update(get_console_output(privacy), refresh=True)
 
             time.sleep(findmy_file_scan_interval)
 
@@ -271,9 +339,16 @@ def validate_param_locations(_, __, path):
 
 
 def set_known_locations(locations):
-    global known_locations
+    global known_locations, known_location_bounds
     _path, _known_locations = locations
     known_locations = _known_locations
+    known_location_bounds = [
+        (name,
+         location['latitude'],
+         location['longitude'],
+         get_lat_lng_approx(location['tolerance'] or DEFAULT_TOLERANCE))
+        for name, location in known_locations.items()
+    ]
 
 
 @click.command("home-assistant-findmy", no_args_is_help=True)
@@ -320,7 +395,10 @@ def main(locations, privacy, force_sync, ip, port, username, password, scan_inte
 
     connect_broker()
     set_known_locations(locations)
-    scan_cache(privacy, force_sync)
+    try:
+        scan_cache(privacy, force_sync)
+    finally:
+        disconnect_broker()
 
 
 if __name__ == '__main__':